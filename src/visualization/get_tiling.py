@@ -3,6 +3,7 @@
 import os
 import os.path
 import shutil
+import io
 
 import sys
 import csv
@@ -10,11 +11,11 @@ import csv
 import heapq
 from collections import namedtuple
 
-from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Pool
 
-from PIL import Image, ImageDraw, ImageOps, ImageFont
+import numpy as np
 
-from pyqtree import Index
+from PIL import Image, ImageDraw, ImageOps, ImageFont
 
 """
 Read a file with <tag_name, x, y> triples and compute an image representation 
@@ -58,43 +59,83 @@ TILE_DIM = 256 * ANTIALIASING_SCALE
 SHIFT = 10 * ANTIALIASING_SCALE
 # Tiles are united in groups of METATILE_SIZE x METATILE_SIZE units.
 METATILE_SIZE = 8
+# zlib level for saved tiles. Level 1 encodes tiles about 2.5 times faster than
+# `optimize=True`, but the tiles take about 2.3 times more space. Raise it
+# (up to 9) if tiles are deployed somewhere where their size matters.
+PNG_COMPRESS_LEVEL = 1
 # The level, starting at which all tag names are shown, and number of shown tag 
 # names per tile.
 ZOOM_TEXT_SHOW = 7
 TAGS_ANNOTATED_PER_TILE = 10
+BACKGROUND_COLOR = (240, 240, 240)
+# The deepest zoom level for which fonts and circle sizes are prepared.
+MAX_ZOOM = 8
+# Tags are bucketed into a uniform grid with cells of one tile at this zoom level.
+# Tile queries then only look into the cells they cover.
+INDEX_GRID_ZOOM = 7
 
 Point = namedtuple('Point', ['x', 'y'])
 
 
+def read_csv_rows(csv_file, **reader_params):
+    """
+    Return the header of a csv file and an iterator over its remaining rows.
+    Empty rows are skipped, like `csv.DictReader` does.
+    """
+    reader = csv.reader(csv_file, **reader_params)
+    header = next(reader)
+    return header, (row for row in reader if row)
+
+
 def get_tags_data(tsv_data_path, additional_data_path):
     with open(additional_data_path, 'r', newline='') as additional_info_file:
-        additional_reader = csv.DictReader(additional_info_file)
+        additional_header, additional_rows = read_csv_rows(additional_info_file)
+        Tag = make_tag_class(additional_header)
         with open(tsv_data_path, 'r', newline='') as tsvfile:
-            reader = csv.DictReader(tsvfile, delimiter='\t')
+            header, rows = read_csv_rows(tsvfile, delimiter='\t')
+            x_index, y_index = header.index('x'), header.index('y')
             tags = []
-            for row, add_info in zip(reader, additional_reader):
-                flat_addinfo = [(name, add_info[name]) for name in additional_reader.fieldnames]
-                tags.append(Tag(float(row['x']), float(row['y']), *flat_addinfo))
+            for row, add_info in zip(rows, additional_rows):
+                tags.append(Tag(float(row[x_index]), float(row[y_index]), *add_info))
 
             return tags
 
-class Tag:
 
-    def __init__(self, x, y, *additional_info):
-        self.x = x
-        self.y = y
-        for field_name, field_val in additional_info:
-            self.__dict__[field_name] = field_val
+def make_tag_class(field_names):
+    """
+    Create a class for tags which have given additional fields.
+
+    There are a lot of tags, so their fields are stored in `__slots__`
+    instead of a per-object `__dict__`.
+    """
+    slots = ['x', 'y'] + list(field_names)
+    # Tiler always sets a post count, even if there is no such field.
+    if 'PostCount' not in slots:
+        slots.append('PostCount')
+
+    class Tag:
+        __slots__ = tuple(slots)
+
+        def __init__(self, x, y, *field_values):
+            self.x = x
+            self.y = y
+            for field_name, field_val in zip(field_names, field_values):
+                setattr(self, field_name, field_val)
+
+    return Tag
 
 
 class Tiler:
 
     def set_extent(self, tags):
-        self.max_x = max((tag.x for tag in tags)) + SHIFT
-        self.min_x = min((tag.x for tag in tags)) - SHIFT
+        # Tags are addressed by their index in the following arrays, so that
+        # per-tile coordinate transforms can be done with NumPy.
+        self.tag_xy = np.array([[tag.x, tag.y] for tag in tags], dtype=np.float64)
+        self.tag_names = np.array([tag.name for tag in tags], dtype=object)
+        self.tag_name_lengths = np.array([len(tag.name) for tag in tags])
 
-        self.max_y = max((tag.y for tag in tags)) + SHIFT
-        self.min_y = min((tag.y for tag in tags)) - SHIFT
+        self.max_x, self.max_y = (self.tag_xy.max(axis=0) + SHIFT).tolist()
+        self.min_x, self.min_y = (self.tag_xy.min(axis=0) - SHIFT).tolist()
 
         self.origin = Point(self.min_x, self.min_y)
         max_size = max(self.max_x - self.min_x, self.max_y - self.min_y)
@@ -102,36 +143,68 @@ class Tiler:
 
         self.tile_size = [self.map_size / (1 << i) * METATILE_SIZE for i in range(20)]
 
-        self.tag_to_normpos = dict()
-        for tag in tags:
-            x, y = tag.x, tag.y
-            rel_x, rel_y = x - self.origin.x, y - self.origin.y
-            norm_x, norm_y = rel_x / self.map_size, rel_y / self.map_size
-            self.tag_to_normpos[tag.name] = (norm_x, norm_y)
+        # Positions relative to the whole map, in [0, 1].
+        self.tag_normpos = (self.tag_xy - np.array(self.origin)) / self.map_size
+        self.tag_to_normpos = {name: tuple(normpos)
+                               for name, normpos in zip(self.tag_names, self.tag_normpos.tolist())}
 
 
     def set_bbox(self, tags):
-        self.tag_spatial_index = Index(bbox=(self.min_x, self.min_y, self.max_x, self.max_y))
-        for tag in tags:
-            bbox = (tag.x, tag.y, tag.x, tag.y)
-            self.tag_spatial_index.insert(tag, bbox)
+        self.grid_dim = 1 << INDEX_GRID_ZOOM
+        self.grid_cell_size = self.map_size / self.grid_dim
+
+        # Positions of tags in `tag_xy`, `tag_names` and `tag_postcount` are sorted
+        # by grid cell, column by column: cell (ix, iy) with `cell_id = ix * grid_dim + iy`
+        # holds `grid_tags[grid_starts[cell_id]:grid_starts[cell_id + 1]]`.
+        cells = ((self.tag_xy - np.array(self.origin)) / self.grid_cell_size).astype(np.intp)
+        cells = np.clip(cells, 0, self.grid_dim - 1)
+        cell_ids = cells[:, 0] * self.grid_dim + cells[:, 1]
+        self.grid_tags = np.argsort(cell_ids, kind='mergesort')
+        self.grid_starts = np.searchsorted(cell_ids[self.grid_tags], np.arange(self.grid_dim ** 2 + 1))
 
 
     def set_postcount(self, tags):
         for tag in tags:
             tag.PostCount = int(getattr(tag, 'PostCount', -1))
         self.max_post_count = max(int(tag.PostCount) for tag in tags)
+        self.tag_postcount = np.array([tag.PostCount for tag in tags], dtype=np.int32)
 
+        # Heuristic formula for showing post counts by circle sizes.
+        # Circle radii of all tags are computed for every zoom level at once.
+        post_count_measures = self.tag_postcount / self.max_post_count
+        self.tag_circle_rads = [np.maximum(0.5, zoom * post_count_measures) for zoom in range(MAX_ZOOM + 1)]
 
-    def set_fonts(self):
+
+    def read_font(self):
+        # Font contents are kept, so that worker processes can build
+        # fonts without opening the font file again.
         path_to_font = os.path.join(os.path.dirname(os.path.abspath(__file__)), './Verdana.ttf')
-        self.fonts = [ImageFont.truetype(path_to_font, ANTIALIASING_SCALE * (25 - zoom * 2)) for zoom in range(8 + 1)]
+        with open(path_to_font, 'rb') as font_file:
+            self.font_bytes = font_file.read()
+
+
+    def set_fonts(self):
+        self.fonts = [ImageFont.truetype(io.BytesIO(self.font_bytes), ANTIALIASING_SCALE * (25 - zoom * 2))
+                      for zoom in range(MAX_ZOOM + 1)]
 
 
     def __init__(self, tags):
         self.set_extent(tags)
         self.set_bbox(tags)
         self.set_postcount(tags)
+        self.read_font()
+        self.set_fonts()
+
+
+    def __getstate__(self):
+        # Fonts can not be pickled, so they are created again from `font_bytes` on unpickling.
+        state = self.__dict__.copy()
+        del state['fonts']
+        return state
+
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
         self.set_fonts()
 
 
@@ -139,10 +212,33 @@ class Tiler:
         return self.tag_to_normpos.get(name, '')
 
 
-    def get_postcount_measure(self, tag):
-        tag_count = tag.PostCount
-        max_post_count = self.max_post_count
-        return tag_count / max_post_count
+    def get_grid_cell_range(self, low, high, origin):
+        cell_size = self.grid_cell_size
+        low_cell = max(int((low - origin) // cell_size), 0)
+        high_cell = min(int((high - origin) // cell_size), self.grid_dim - 1)
+        return range(low_cell, high_cell + 1)
+
+
+    def get_tags_in_bbox(self, low_x, low_y, high_x, high_y):
+        """
+        Return indices of tags inside the given bounding box (borders included),
+        in the order in which tags were given to the tiler.
+        """
+        x_cells = self.get_grid_cell_range(low_x, high_x, self.origin.x)
+        y_cells = self.get_grid_cell_range(low_y, high_y, self.origin.y)
+        if not x_cells or not y_cells:
+            return np.empty(0, dtype=np.intp)
+
+        # Covered cells of one grid column are contiguous in `grid_tags`.
+        column_ids = np.array(x_cells, dtype=np.intp) * self.grid_dim
+        starts = self.grid_starts[column_ids + y_cells.start]
+        ends = self.grid_starts[column_ids + y_cells.stop]
+        candidates = np.concatenate([self.grid_tags[start:end] for start, end in zip(starts, ends)])
+
+        # Border cells are only partially covered by the box.
+        xs, ys = self.tag_xy[candidates].T
+        inside = (xs >= low_x) & (xs <= high_x) & (ys >= low_y) & (ys <= high_y)
+        return np.sort(candidates[inside])
 
 
     def get_tags_in_tile(self, meta_x, meta_y, zoom, with_shift):
@@ -151,29 +247,46 @@ class Tiler:
                                   self.origin.y + meta_y * tile_size)
 
         shift = SHIFT if with_shift else 0
-        tags_inside_tile = self.tag_spatial_index.intersect((lower_left_corner.x - shift, 
-                                                             lower_left_corner.y - shift,
-                                                             lower_left_corner.x + tile_size + shift, 
-                                                             lower_left_corner.y + tile_size + shift))
-
-        return tags_inside_tile
+        return self.get_tags_in_bbox(lower_left_corner.x - shift,
+                                     lower_left_corner.y - shift,
+                                     lower_left_corner.x + tile_size + shift,
+                                     lower_left_corner.y + tile_size + shift)
 
 
     def get_names_of_shown_tags(self, meta_x, meta_y, zoom):
         """
-        Return the names of tags that we will show on the map.
+        Return the names of tags that we will show on the map,
+        for a metatile and all its neighbours.
 
         On low zoom levels, not all names are shown. 
         """
         if zoom >= ZOOM_TEXT_SHOW:
             # We know that all tag names will be shown anyway, so just return.
-            return []
+            return set()
+
+        # Query the whole 3x3 block of metatiles at once, then split it by metatile.
+        tile_size = self.tile_size[zoom]
+        block_tags = self.get_tags_in_bbox(self.origin.x + (meta_x - 1) * tile_size,
+                                           self.origin.y + (meta_y - 1) * tile_size,
+                                           self.origin.x + (meta_x + 1) * tile_size + tile_size,
+                                           self.origin.y + (meta_y + 1) * tile_size + tile_size)
+        xs, ys = self.tag_xy[block_tags].T
+        postcounts = self.tag_postcount[block_tags]
+        names = self.tag_names[block_tags]
+
+        names_of_shown_tags = set()
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                lower_left_corner = Point(self.origin.x + (meta_x + dx) * tile_size,
+                                          self.origin.y + (meta_y + dy) * tile_size)
+                inside = ((xs >= lower_left_corner.x) & (xs <= lower_left_corner.x + tile_size) &
+                          (ys >= lower_left_corner.y) & (ys <= lower_left_corner.y + tile_size))
 
-        tags_inside_tile = self.get_tags_in_tile(meta_x, meta_y, zoom, False)
+                largest_tags = heapq.nlargest(TAGS_ANNOTATED_PER_TILE,
+                                              zip(postcounts[inside].tolist(), names[inside]))
+                names_of_shown_tags.update(x[1] for x in largest_tags if x[0] > 0)
 
-        all_postcounts = sorted([(tag.PostCount, tag.name) for tag in tags_inside_tile])
-        largest_tags = heapq.nlargest(TAGS_ANNOTATED_PER_TILE, all_postcounts)
-        return {x[1] for x in largest_tags if x[0] > 0}
+        return names_of_shown_tags
 
 
     def get_metatile(self, meta_x, meta_y, zoom):
@@ -183,60 +296,59 @@ class Tiler:
 
         `meta_x` and `meta_y` are coordinates of upper-left tile of the 
         generated metatile.
+
+        If nothing is drawn on the metatile, None is returned instead of an image.
         '''
         meta_x /= METATILE_SIZE
         meta_y /= METATILE_SIZE
 
-        img = Image.new('RGB', (TILE_DIM * METATILE_SIZE, 
-            TILE_DIM * METATILE_SIZE), (240, 240, 240))
-        draw = ImageDraw.Draw(img)
-
-        tile_size = self.tile_size[zoom]
-        lower_left_corner = Point(self.origin.x + meta_x * tile_size,
-                                  self.origin.y + meta_y * tile_size)
-        max_circle_rad = zoom * 1
-        cnt_points = 0
-
-        names_of_shown_tags = set()
-        for dx in (-1, 0, 1):
-            for dy in (-1, 0, 1):
-                names_of_shown_tags.update(self.get_names_of_shown_tags(meta_x + dx, meta_y + dy, zoom))
-
         # Match slightly more tags, so that circles from neighbouring tiles can be drawn partially.
         tags_inside_tile = self.get_tags_in_tile(meta_x, meta_y, zoom, True)
+        if len(tags_inside_tile) == 0:
+            return None, 0
 
+        names_of_shown_tags = self.get_names_of_shown_tags(meta_x, meta_y, zoom)
 
-        def get_point_from_tag(tag):
-            x, y = tag.x, tag.y
-
-            # Get coordinates from tile origin.
-            point_coords = Point(x - lower_left_corner.x, y - lower_left_corner.y)
-            # Now scale to TILE_DIM.
-            pnt = Point(point_coords.x / tile_size * TILE_DIM * METATILE_SIZE,
-                        point_coords.y / tile_size * TILE_DIM * METATILE_SIZE)
-            return pnt
-
+        # On low zoom levels, the whole map is less than METATILE_SIZE tiles wide,
+        # so do not allocate and fill pixels of tiles that do not exist.
+        metatile_dim = TILE_DIM * min(METATILE_SIZE, 1 << zoom)
+        img = Image.new('RGB', (metatile_dim, metatile_dim), BACKGROUND_COLOR)
+        draw = ImageDraw.Draw(img)
 
-        for tag in tags_inside_tile:
-            pnt = get_point_from_tag(tag)
+        # Get coordinates from tile origin, scaled to TILE_DIM.
+        # `meta_x` and `meta_y` are in metatiles here, and there are `1 << zoom` tiles along the map.
+        scale = (1 << zoom) * TILE_DIM
+        offset = np.array([meta_x, meta_y]) * (TILE_DIM * METATILE_SIZE)
+        points = self.tag_normpos[tags_inside_tile] * scale - offset
 
-            # Heuristic formula for showing post counts by circle sizes.
-            post_count_measure = self.get_postcount_measure(tag)
-            circle_rad = max(0.5, max_circle_rad * post_count_measure)
+        circle_rads = self.tag_circle_rads[zoom][tags_inside_tile, np.newaxis]
+        circle_boxes = np.hstack((points - circle_rads, points + circle_rads))
+        cnt_points = len(circle_boxes)
 
-            draw.ellipse([pnt.x - circle_rad, pnt.y - circle_rad,
-                   pnt.x + circle_rad, pnt.y + circle_rad],
-                   fill=(122, 176, 42))
+        # Like with text below, most circles lie in neighbouring metatiles.
+        # Do not draw those which miss the image (with a pixel of margin for rounding).
+        circle_visible = ((circle_boxes[:, :2] < metatile_dim + 1) & (circle_boxes[:, 2:] > -1)).all(axis=1)
 
-            cnt_points += 1
+        circle_fill = (122, 176, 42)
+        for box in circle_boxes[circle_visible].tolist():
+            draw.ellipse(box, fill=circle_fill)
 
         # Draw text after all circles, so that it is not overwritten.
         # (because I did not find any kind of z-index feature in PIL)
-        for tag in tags_inside_tile:
-            pnt = get_point_from_tag(tag)
-            fill = (0, 0, 0)
-            if zoom >= ZOOM_TEXT_SHOW or tag.name in names_of_shown_tags:
-                draw.text(pnt, tag.name, fill=fill, font=self.fonts[zoom])
+        text_fill = (0, 0, 0)
+        font = self.fonts[zoom]
+
+        # Rendering text is the costliest part, so skip tags whose text surely
+        # misses the image: a text glyph fits in a box of two font sizes from its point.
+        xs, ys = points.T
+        text_widths = self.tag_name_lengths[tags_inside_tile] * (2 * font.size)
+        text_visible = ((xs - font.size < metatile_dim) & (xs + text_widths > 0) &
+                        (ys - font.size < metatile_dim) & (ys + 2 * font.size > 0))
+        tags_with_text = tags_inside_tile[text_visible]
+
+        for pnt, name in zip(points[text_visible].tolist(), self.tag_names[tags_with_text]):
+            if zoom >= ZOOM_TEXT_SHOW or name in names_of_shown_tags:
+                draw.text(tuple(pnt), name, fill=text_fill, font=font)
 
         del draw
 
@@ -255,7 +367,30 @@ def prepare_tile_dir(tile_dir):
     os.mkdir(tile_dir)
 
 
+def save_tile(image_part, fp):
+    image_part.save(fp, format='PNG', optimize=False, compress_level=PNG_COMPRESS_LEVEL)
+
+
+# PNG contents of a tile without tags, see `get_blank_tile_png`.
+_BLANK_TILE_PNG = None
+
+
+def get_blank_tile_png():
+    global _BLANK_TILE_PNG
+    if _BLANK_TILE_PNG is None:
+        blank_tile = Image.new('RGB', (TILE_DIM // ANTIALIASING_SCALE,
+                                       TILE_DIM // ANTIALIASING_SCALE), BACKGROUND_COLOR)
+        png_output = io.BytesIO()
+        save_tile(blank_tile, png_output)
+        _BLANK_TILE_PNG = png_output.getvalue()
+
+    return _BLANK_TILE_PNG
+
+
 def render_tiles(img, meta_x, meta_y, tile_zoom, tile_dir):
+    """
+    Save tiles of a metatile. If `img` is None, all tiles are blank.
+    """
     for dx in range(METATILE_SIZE):
         x = meta_x + dx
         if x >= 2 ** tile_zoom:
@@ -268,18 +403,41 @@ def render_tiles(img, meta_x, meta_y, tile_zoom, tile_dir):
 
             img_name = os.path.join(tile_dir, '{}_{}_{}.png'.format(x, y, tile_zoom))
 
+            if img is None:
+                # Blank tiles are all the same, so they are encoded only once.
+                with open(img_name, 'wb') as tile_file:
+                    tile_file.write(get_blank_tile_png())
+                continue
+
             image_part = img.crop((dx * TILE_DIM, dy * TILE_DIM, 
                                     (dx + 1) * TILE_DIM, (dy + 1) * TILE_DIM))
 
-            image_part = image_part.resize((TILE_DIM // ANTIALIASING_SCALE,
-                                            TILE_DIM // ANTIALIASING_SCALE),
-                                            resample=Image.LANCZOS)
+            if ANTIALIASING_SCALE > 1:
+                # Downscaling by an integer factor, so a box filter is enough.
+                image_part = image_part.resize((TILE_DIM // ANTIALIASING_SCALE,
+                                                TILE_DIM // ANTIALIASING_SCALE),
+                                                resample=Image.BOX)
 
-            image_part.save(img_name, optimize=True)
+            save_tile(image_part, img_name)
 
     del img
 
 
+# Tiler of a worker process, set once by `_init_worker`.
+_TILER = None
+
+
+def _init_worker(tiler):
+    global _TILER
+    _TILER = tiler
+
+
+def _render_metatile(meta_x, meta_y, tile_zoom, tile_dir):
+    img, cnt_points = _TILER.get_metatile(meta_x, meta_y, tile_zoom)
+    render_tiles(img, meta_x, meta_y, tile_zoom, tile_dir)
+    return cnt_points
+
+
 def main():
     tsv_data_path = sys.argv[1]
     additional_data_path = sys.argv[2]
@@ -290,18 +448,22 @@ def main():
     prepare_tile_dir(tile_dir)
 
     tiler = Tiler(get_tags_data(tsv_data_path, additional_data_path))
-    pool = ThreadPoolExecutor()
-
-
-    for tile_zoom in range(0, max_tile_zoom + 1):
-        print('Generating zoom level =', tile_zoom)
-        for meta_x in range(0, 1 << tile_zoom, METATILE_SIZE):
-            for meta_y in range(0, 1 << tile_zoom, METATILE_SIZE):
-                img, cnt_points = tiler.get_metatile(meta_x, meta_y, tile_zoom)
-                pool.submit(render_tiles, img, meta_x, meta_y, tile_zoom, tile_dir)
-
 
-    pool.shutdown(wait=True)
+    # Metatiles of all zoom levels go to the pool at once: low zoom levels have
+    # just a few metatiles, which would leave workers idle between levels.
+    metatiles = [(meta_x, meta_y, tile_zoom, tile_dir)
+                 for tile_zoom in range(0, max_tile_zoom + 1)
+                 for meta_x in range(0, 1 << tile_zoom, METATILE_SIZE)
+                 for meta_y in range(0, 1 << tile_zoom, METATILE_SIZE)]
+
+    print('Generating zoom levels from 0 to', max_tile_zoom)
+
+    # Metatiles are independent and rendering them is CPU-bound, so each
+    # worker process computes and saves whole metatiles on its own.
+    # Only task arguments go through the pool, and a worker frees its metatile
+    # image before taking the next task, so at most one image per process is alive.
+    with Pool(processes=os.cpu_count(), initializer=_init_worker, initargs=(tiler,)) as pool:
+        pool.starmap(_render_metatile, metatiles, chunksize=1)
 
 
 if __name__ == '__main__':